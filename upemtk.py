@@ -7,9 +7,16 @@
 
 # Dernière mise à jour : Nov. 2019
 
+import atexit
+import os
+import queue
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import tkinter as tk
+import warnings
 from collections import deque
 from time import time, sleep
 from tkinter.font import Font
@@ -36,6 +43,8 @@ __all__ = [
     # utilitaires
     'attendre',
     'capture_ecran',
+    'demarrer_enregistrement',
+    'arreter_enregistrement',
     'touche_pressee',
     'premier_plan',
     'arriere_plan',
@@ -101,11 +110,17 @@ class CustomCanvas:
         # marque
         self.tailleMarque = 5
 
+        # frame recorder, see demarrer_enregistrement
+        self.recorder = None
+
         # update for the first time
         self.last_update = time()
         self.root.update()
 
     def update(self):
+        # capturing before measuring t lets the sleep below absorb its cost
+        if self.recorder:
+            self.recorder.capture()
         t = time()
         self.root.update()
         sleep(max(0., self.period - (t - self.last_update)))
@@ -156,6 +171,161 @@ class CustomCanvas:
         self.canvas.unbind(e_type)
 
 
+class FrameRecorder:
+    """
+    Enregistre des images successives d'un canevas. Les images sont
+    capturées dans le thread principal puis transmises, via une file
+    bornée, à un thread d'encodage qui les convertit avec ImageMagick.
+    """
+
+    _formats = ('gif', 'ppm')
+
+    def __init__(self, canvas, filename, fmt='gif', fps=10, queue_size=32,
+                 blocking=False):
+        self.canvas = canvas
+        self.filename = filename
+        self.format = fmt
+        self.period = 1 / fps
+        self.blocking = blocking
+
+        # (timestamp, frame) couples waiting to be encoded, None marks the
+        # end of the recording
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.next_capture = None
+        self.captured = 0
+        self.dropped = 0
+        self.error = None
+        self.error_reported = False
+
+        # gif frames are rasterized in a temporary directory, then assembled
+        self.workdir = tempfile.mkdtemp() if fmt == 'gif' else None
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+        # the encoder thread is a daemon, finish the recording if the
+        # program ends without stopping it
+        atexit.register(self.stop_at_exit)
+
+    def capture(self):
+        if self.error:
+            if not self.error_reported:
+                warnings.warn(
+                    f"L'encodage de l'enregistrement a échoué : {self.error}",
+                    RuntimeWarning)
+                self.error_reported = True
+            return
+        t = time()
+        if self.next_capture is not None and t < self.next_capture:
+            return
+        # keep a fixed schedule, unless the loop fell more than a period
+        # behind it
+        if self.next_capture is None or t - self.next_capture > self.period:
+            self.next_capture = t + self.period
+        else:
+            self.next_capture += self.period
+        # scaling the page to width points gives one pixel per point
+        data = self.canvas.canvas.postscript(
+            width=self.canvas.width, height=self.canvas.height,
+            pagewidth=str(self.canvas.width) + 'p', colormode='color')
+        try:
+            self.frames.put((t, data), block=self.blocking)
+        except queue.Full:
+            if not self.dropped:
+                warnings.warn(
+                    "L'encodeur ne suit pas le rythme de l'enregistrement,"
+                    " des images sont abandonnées.", RuntimeWarning)
+            self.dropped += 1
+        else:
+            self.captured += 1
+
+    def rasterize(self, data, index, delay=None):
+        if self.format == 'gif':
+            # miff keeps the delay of each frame until the gif is assembled
+            path = "miff:" + os.path.join(self.workdir, f"{index:06d}.miff")
+        else:
+            path = f"ppm:{self.filename}_{index:05d}.ppm"
+        subprocess.run(
+            ["convert"]
+            + (["-delay", str(delay)] if delay is not None else [])
+            + ["-background", "white", "-flatten", "eps:-"]
+            + (["-compress", "Zip"] if self.format == 'gif' else [])
+            + [path],
+            input=data.encode(), check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def encode(self):
+        index = 0
+        # gif frames wait for the next one to know how long they last, in
+        # hundredths of a second since the first capture
+        pending = None
+        first = None
+        elapsed = 0
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error:
+                # keep draining so that a blocking capture never hangs
+                continue
+            try:
+                if self.format == 'gif':
+                    t, data = frame
+                    if first is None:
+                        first = t
+                    if pending:
+                        # viewers slow down delays under 2 hundredths
+                        delay = max(2, round(100 * (t - first)) - elapsed)
+                        self.rasterize(pending, index, delay)
+                        elapsed += delay
+                        index += 1
+                    pending = data
+                else:
+                    self.rasterize(frame[1], index)
+                    index += 1
+            except (OSError, subprocess.CalledProcessError) as e:
+                self.fail(e)
+
+        try:
+            if pending and not self.error:
+                self.rasterize(pending, index,
+                               max(2, round(100 * self.period)))
+                subprocess.run(
+                    ["convert", "-loop", "0",
+                     os.path.join(self.workdir, "*.miff"),
+                     self.filename + ".gif"],
+                    check=True, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.fail(e)
+        finally:
+            if self.workdir:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def fail(self, e):
+        # ImageMagick explains its failures (missing ghostscript, security
+        # policy, ...) on stderr, which is more useful than the command line
+        if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+            self.error = e.stderr.decode(errors='replace').strip()
+        else:
+            self.error = str(e)
+
+    def stop_at_exit(self):
+        try:
+            self.stop()
+        except RecordingError as e:
+            warnings.warn(str(e), RuntimeWarning)
+
+    def stop(self):
+        atexit.unregister(self.stop_at_exit)
+        self.frames.put(None)
+        self.thread.join()
+        if self.error:
+            raise RecordingError(
+                f"L'encodage de l'enregistrement a échoué : {self.error}")
+        return self.captured, self.dropped
+
+
 __canvas = None
 __img = dict()
 
@@ -177,6 +347,10 @@ class EventListenerError(Exception):
     pass
 
 
+class RecordingError(Exception):
+    pass
+
+
 #############################################################################
 # Initialisation, mise à jour et fermeture
 #############################################################################
@@ -196,14 +370,21 @@ def creer_fenetre(largeur, hauteur, frequence=100, nom=None, evenements=None):
 
 def fermer_fenetre():
     """
-    Détruit la fenêtre.
+    Détruit la fenêtre. Un enregistrement en cours est arrêté ; un échec de
+    son encodage est signalé par un avertissement.
     """
     global __canvas
     if not __canvas:
         raise WindowError(
             "La fenêtre n'a pas été créée avec la fonction \"creer_fenetre\" !")
+    recorder = __canvas.recorder
     __canvas.root.destroy()
     __canvas = None
+    if recorder:
+        try:
+            recorder.stop()
+        except RecordingError as e:
+            warnings.warn(str(e), RuntimeWarning)
 
 
 def rafraichir():
@@ -504,6 +685,80 @@ def capture_ecran(file: str):
     subprocess.call("rm " + file + ".ps", shell=True)
 
 
+def demarrer_enregistrement(fichier: str, format: str = 'gif',
+                            images_par_seconde: float = 10,
+                            taille_file: int = 32, bloquant: bool = False):
+    """
+    Démarre l'enregistrement de la fenêtre. Une image est capturée lors des
+    appels à ``rafraichir`` au plus ``images_par_seconde`` fois par seconde,
+    puis encodée en arrière-plan dans ``fichier.gif`` (format ``'gif'``) ou
+    dans la séquence ``fichier_00000.ppm``, ``fichier_00001.ppm``, etc.
+    (format ``'ppm'``).
+
+    Lorsque la file d'attente est pleine, l'image est abandonnée pour ne pas
+    ralentir la fenêtre, sauf si ``bloquant`` vaut `True` : ``rafraichir``
+    attend alors que l'encodeur libère de la place.
+    Chaque image du GIF dure le temps réellement écoulé jusqu'à la capture
+    suivante, de sorte que les images abandonnées ne faussent pas la
+    vitesse de lecture. Le GIF est assemblé à l'arrêt à partir d'images
+    intermédiaires conservées sur le disque : il convient aux
+    enregistrements courts, la séquence PPM aux enregistrements longs.
+
+    Un enregistrement qui n'a pas été arrêté avec ``arreter_enregistrement``
+    ou ``fermer_fenetre`` est terminé à la fin du programme.
+
+    :param fichier: Nom du fichier produit, sans extension.
+    :param format: Format d'export, ``'gif'`` ou ``'ppm'`` (défaut 'gif').
+    :param images_par_seconde: Fréquence de capture, au plus 50 pour le
+        format ``'gif'`` (défaut 10).
+    :param taille_file: Nombre maximal d'images en attente d'encodage
+        (défaut 32).
+    :param bloquant: Attendre l'encodeur plutôt qu'abandonner des images
+        (défaut `False`).
+    """
+    if not __canvas:
+        raise WindowError(
+            "La fenêtre n'a pas été créée avec la fonction \"creer_fenetre\" !")
+    if __canvas.recorder:
+        raise RecordingError("Un enregistrement est déjà en cours !")
+    if format not in FrameRecorder._formats:
+        raise RecordingError(
+            f"Format d'enregistrement {format} inconnu, formats possibles : "
+            + ", ".join(FrameRecorder._formats))
+    if not images_par_seconde > 0:
+        raise RecordingError(
+            "La fréquence de capture doit être strictement positive !")
+    if format == 'gif' and images_par_seconde > 50:
+        raise RecordingError(
+            "Le format GIF ne permet pas plus de 50 images par seconde !")
+    if not taille_file >= 1:
+        raise RecordingError(
+            "La file d'attente doit pouvoir contenir au moins une image !")
+    if shutil.which("convert") is None:
+        raise RecordingError(
+            "L'enregistrement nécessite la commande \"convert\""
+            " d'ImageMagick !")
+    __canvas.recorder = FrameRecorder(__canvas, fichier, format,
+                                      images_par_seconde, taille_file,
+                                      bloquant)
+
+
+def arreter_enregistrement():
+    """
+    Arrête l'enregistrement en cours et attend la fin de l'encodage.
+
+    :return: Couple (n, p) constitué du nombre d'images enregistrées et du
+        nombre d'images abandonnées faute de place dans la file d'attente.
+    """
+    if not __canvas:
+        raise WindowError(
+            "La fenêtre n'a pas été créée avec la fonction \"creer_fenetre\" !")
+    if not __canvas.recorder:
+        raise RecordingError("Aucun enregistrement n'est en cours !")
+    recorder, __canvas.recorder = __canvas.recorder, None
+    return recorder.stop()
+
+
 def touche_pressee(keysym: str):
     """
     Renvoie `True` si ``keysym`` est actuellement pressée.